@@ -13,18 +13,41 @@ Also creates useful indexes for ML / aggregation workloads.
 from __future__ import annotations
 
 import argparse
+import multiprocessing
 import os
-from typing import Dict, Iterable, List
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, Iterable, List, Mapping
 
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient, UpdateOne
-from pymongo.errors import BulkWriteError
+import pyarrow as pa
+import pyarrow.csv as pcsv
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+DUPLICATE_KEY_ERROR = 11000
 
-def _read_csv(path: str) -> pd.DataFrame:
+# Append-only collections: dedup comes from the unique natural-key index, not journaling
+APPEND_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+
+# Column types declared up front so the Arrow parser emits final dtypes directly
+# (no float -> int cast pass afterwards). Columns absent from a file are ignored.
+# Ids fit in int32, which halves their memory; timestamps stay int64 (past 2038).
+MOVIES_TYPES = {"movieId": pa.int32()}
+RATINGS_TYPES = {"userId": pa.int32(), "movieId": pa.int32(), "rating": pa.float32(), "timestamp": pa.int64()}
+TAGS_TYPES = {"userId": pa.int32(), "movieId": pa.int32(), "timestamp": pa.int64()}
+LINKS_TYPES = {"movieId": pa.int32()}
+
+
+def _read_csv(path: str, column_types: Dict[str, pa.DataType] | None = None) -> pd.DataFrame:
     if not os.path.exists(path):
         raise FileNotFoundError(f"Missing file: {path}")
-    return pd.read_csv(path)
+    # strings_can_be_null: empty cells stay missing (as with pandas.read_csv), not ""
+    convert_options = pcsv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+    return pcsv.read_csv(path, convert_options=convert_options).to_pandas()
 
 
 def _chunked(df: pd.DataFrame, chunk_size: int) -> Iterable[pd.DataFrame]:
@@ -33,13 +56,57 @@ def _chunked(df: pd.DataFrame, chunk_size: int) -> Iterable[pd.DataFrame]:
         yield df.iloc[i: i + chunk_size]
 
 
+# Natural keys: unique compound indexes on these make re-runs idempotent
+RATINGS_KEY = [("userId", 1), ("movieId", 1), ("timestamp", 1)]
+TAGS_KEY = [("userId", 1), ("movieId", 1), ("timestamp", 1), ("tag", 1)]
+
+
+def _raw_bson_docs(columns: Mapping[str, np.ndarray]) -> List[RawBSONDocument]:
+    """Encode equal-length numeric columns to BSON column-wise, without per-row dicts.
+
+    Every row has the same layout, so the documents are built as one numpy
+    structured array (length prefix, then per field: type byte + name + value,
+    then the terminator) and sliced into RawBSONDocument objects. Integer columns
+    are written as int32 when every value fits (pymongo decides per value) and
+    floats as doubles.
+    """
+    n = len(next(iter(columns.values()), []))
+    if n == 0:
+        return []
+    fields = [("_len", "<i4")]
+    values = {}
+    for c, col in columns.items():
+        name = c.encode() + b"\x00"
+        if col.dtype.kind in "iu":
+            small = col.min() >= np.iinfo(np.int32).min and col.max() <= np.iinfo(np.int32).max
+            header, dtype = (b"\x10" if small else b"\x12") + name, ("<i4" if small else "<i8")
+        elif col.dtype.kind == "f":
+            header, dtype = b"\x01" + name, "<f8"
+        else:
+            raise TypeError(f"Column {c} has unsupported dtype {col.dtype} for raw BSON encoding")
+        fields += [(f"_{c}_header", f"S{len(header)}"), (c, dtype)]
+        values[f"_{c}_header"] = header
+        values[c] = col
+    fields.append(("_end", "S1"))
+
+    rows = np.zeros(n, dtype=fields)
+    width = rows.dtype.itemsize
+    rows["_len"] = width
+    for name, value in values.items():
+        rows[name] = value
+    blob = rows.tobytes()
+    return [RawBSONDocument(blob[i: i + width]) for i in range(0, len(blob), width)]
+
+
 def _upsert_many(col, docs: List[Dict], key_field: str, chunk_size: int = 2000) -> None:
     """Upsert docs by key_field using bulk writes (efficient + idempotent)."""
     ops: List[UpdateOne] = []
     for d in docs:
         if key_field not in d:
             raise ValueError(f"Document missing key_field={key_field}: {d}")
-        ops.append(UpdateOne({key_field: d[key_field]}, {"$set": d}, upsert=True))
+        # key_field is already in the filter (and copied in on upsert), so leave it out of $set
+        fields = {k: v for k, v in d.items() if k != key_field}
+        ops.append(UpdateOne({key_field: d[key_field]}, {"$set": fields}, upsert=True))
 
     if not ops:
         return
@@ -52,12 +119,95 @@ def _upsert_many(col, docs: List[Dict], key_field: str, chunk_size: int = 2000)
             print("BulkWriteError:", e.details)
 
 
+def _rebuild(col, docs: List[Dict]) -> None:
+    """Full refresh: drop the collection and bulk insert; indexes are built afterwards."""
+    col.drop()
+    if docs:
+        col.insert_many(docs, ordered=False)
+
+
+def _insert_ignore_duplicates(col, docs: List[Mapping]) -> None:
+    """Insert docs unordered; duplicate-key errors (re-runs) are expected and ignored."""
+    if not docs:
+        return
+    try:
+        col.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = [w for w in e.details.get("writeErrors", []) if w.get("code") != DUPLICATE_KEY_ERROR]
+        if errors or e.details.get("writeConcernErrors"):
+            print("BulkWriteError:", e.details)
+
+
+def _create_unique_index(col, keys: List) -> None:
+    """Create a unique index on keys, first removing duplicate rows if the build fails.
+
+    Duplicates can exist when the index is built after a bulk load (or a load was
+    interrupted before it was built). Like the old upserts, the first inserted copy
+    (lowest ObjectId) is kept. The grouping pass reads every document but only
+    carries one _id and a count per key; deletes are issued for duplicate keys only.
+    """
+    try:
+        col.create_index(keys, unique=True)
+        return
+    except DuplicateKeyError:
+        pass
+    print(f"Removing duplicate {col.name} rows before building the unique index...")
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {f: f"${f}" for f, _ in keys}, "keep": {"$first": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    groups = col.aggregate(pipeline, allowDiskUse=True)
+    ops = [DeleteMany({**g["_id"], "_id": {"$ne": g["keep"]}}) for g in groups]
+    for i in range(0, len(ops), 10_000):
+        col.bulk_write(ops[i: i + 10_000], ordered=False)
+    col.create_index(keys, unique=True)
+
+
+def _drop_legacy_key(col, field: str) -> None:
+    """Remove a synthetic key (_rid/_tid) left by older loads, with its unique index.
+
+    New documents lack the field, so the old unique index would treat them all as
+    null and reject every new row after the first as a "duplicate".
+    """
+    index_name = f"{field}_1"
+    if index_name not in col.index_information():
+        return
+    print(f"Dropping legacy {col.name}.{field} key and index...")
+    col.drop_index(index_name)
+    col.update_many({field: {"$exists": True}}, {"$unset": {field: ""}})
+
+
+# Per-process database handle for the ingest worker pool (set by _init_worker)
+_worker_db = None
+
+
+def _init_worker(mongo_uri: str, db_name: str, compressors: List[str]) -> None:
+    """Open one MongoClient per worker process; clients must not cross a fork."""
+    global _worker_db
+    _worker_db = MongoClient(mongo_uri, compressors=compressors)[db_name]
+
+
+def _write_chunk(col_name: str, part: pd.DataFrame) -> None:
+    """Encode and insert one ratings chunk from a worker process."""
+    columns = {c: part[c].to_numpy() for c in part.columns}
+    col = _worker_db.get_collection(col_name, write_concern=APPEND_WRITE_CONCERN)
+    _insert_ignore_duplicates(col, _raw_bson_docs(columns))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--data-dir", default="data/ml-latest-small", help="Path to MovieLens folder")
     parser.add_argument("--mongo-uri", default="mongodb://localhost:27017", help="MongoDB connection URI")
     parser.add_argument("--db", default="movielens", help="Database name")
     parser.add_argument("--chunk-size", type=int, default=5000, help="Chunk size for inserts")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Worker processes for the ratings insert")
+    parser.add_argument("--compressors", default=[], type=lambda v: [c for c in v.split(",") if c],
+                        help="Comma-separated wire compressors, e.g. zstd,zlib (default: none; "
+                             "zstd needs Python 3.14+ or backports.zstd)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Drop and reload movies/links instead of upserting them")
     args = parser.parse_args()
 
     movies_path = os.path.join(args.data_dir, "movies.csv")
@@ -66,33 +216,13 @@ def main() -> None:
     links_path = os.path.join(args.data_dir, "links.csv")
 
     print("Reading CSVs...")
-    movies_df = _read_csv(movies_path)
-    ratings_df = _read_csv(ratings_path)
-    tags_df = _read_csv(tags_path) if os.path.exists(tags_path) else pd.DataFrame()
-    links_df = _read_csv(links_path) if os.path.exists(links_path) else pd.DataFrame()
-
-    # Basic cleaning / typing
-    # movies_df["movieId"] = preprocess(movies_df["movieId"])
-    print(movies_df["movieId"][0].dtype)
-    movies_df["movieId"] = movies_df["movieId"].astype(int)
-    print(movies_df["movieId"][0].dtype)
-
-    ratings_df["userId"] = ratings_df["userId"].astype(int)
-    ratings_df["movieId"] = ratings_df["movieId"].astype(int)
-    if "timestamp" in ratings_df.columns:
-        ratings_df["timestamp"] = ratings_df["timestamp"].astype(int)
-
-    if not tags_df.empty:
-        tags_df["userId"] = tags_df["userId"].astype(int)
-        tags_df["movieId"] = tags_df["movieId"].astype(int)
-        if "timestamp" in tags_df.columns:
-            tags_df["timestamp"] = tags_df["timestamp"].astype(int)
-
-    if not links_df.empty:
-        links_df["movieId"] = links_df["movieId"].astype(int)
+    movies_df = _read_csv(movies_path, MOVIES_TYPES)
+    ratings_df = _read_csv(ratings_path, RATINGS_TYPES)
+    tags_df = _read_csv(tags_path, TAGS_TYPES) if os.path.exists(tags_path) else pd.DataFrame()
+    links_df = _read_csv(links_path, LINKS_TYPES) if os.path.exists(links_path) else pd.DataFrame()
 
     print("Connecting to MongoDB...")
-    client = MongoClient(args.mongo_uri)
+    client = MongoClient(args.mongo_uri, compressors=args.compressors)
     print("Available DBs:", client.list_database_names())
 
     db = client[args.db]
@@ -101,88 +231,83 @@ def main() -> None:
 
     # Collections (MongoDB handles)
     c_movies = db["movies"]
-    c_ratings = db["ratings"]
-    c_tags = db["tags"]
+    c_ratings = db.get_collection("ratings", write_concern=APPEND_WRITE_CONCERN)
+    c_tags = db.get_collection("tags", write_concern=APPEND_WRITE_CONCERN)
     c_links = db["links"]
 
     print("Collections handles:", c_movies.full_name, c_ratings.full_name, c_tags.full_name, c_links.full_name)
 
     # ---- Load movies ----
-    print("Upserting movies...")
     movie_docs = movies_df.to_dict(orient="records")
-    _upsert_many(c_movies, movie_docs, key_field="movieId", chunk_size=args.chunk_size)
+    if args.rebuild:
+        print("Rebuilding movies...")
+        _rebuild(c_movies, movie_docs)
+    else:
+        print("Upserting movies...")
+        _upsert_many(c_movies, movie_docs, key_field="movieId", chunk_size=args.chunk_size)
 
     # ---- Load ratings ----
     print("Inserting ratings (append-only; safe to re-run)...")
-    ratings_df = ratings_df.copy()
-    ratings_df["_rid"] = (
-        ratings_df["userId"].astype(str)
-        + "_"
-        + ratings_df["movieId"].astype(str)
-        + "_"
-        + ratings_df["timestamp"].astype(str)
-    )
-
-    c_ratings.create_index("_rid", unique=True)
-
-    for part in _chunked(ratings_df, args.chunk_size):
-        if part.empty:
-            continue
-        docs = part.to_dict(orient="records")
-        ops = [UpdateOne({"_rid": d["_rid"]}, {"$setOnInsert": d}, upsert=True) for d in docs]
-        try:
-            c_ratings.bulk_write(ops, ordered=False)
-        except BulkWriteError:
-            # duplicates are okay if rerun
-            pass
+    _drop_legacy_key(c_ratings, "_rid")
+
+    # On a first load the unique key index is built after the bulk insert (one sorted
+    # build instead of per-document B-tree maintenance). Re-runs need it up front so
+    # that already-loaded rows are rejected as duplicates.
+    ratings_first_load = c_ratings.estimated_document_count() == 0
+    if not ratings_first_load:
+        _create_unique_index(c_ratings, RATINGS_KEY)
+
+    # BSON encoding is GIL-bound, so chunks fan out to processes with their own clients.
+    # duplicates are okay if rerun
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(args.mongo_uri, args.db, args.compressors),
+    ) as ex:
+        list(ex.map(_write_chunk, repeat(c_ratings.name), _chunked(ratings_df, args.chunk_size)))
 
     # ---- Load tags ----
     if not tags_df.empty:
         print("Inserting tags...")
-        tags_df = tags_df.copy()
-        tags_df["_tid"] = (
-            tags_df["userId"].astype(str)
-            + "_"
-            + tags_df["movieId"].astype(str)
-            + "_"
-            + tags_df["timestamp"].astype(str)
-            + "_"
-            + tags_df["tag"].astype(str)
-        )
-        c_tags.create_index("_tid", unique=True)
+        _drop_legacy_key(c_tags, "_tid")
+        # tags is small, so its unique index is always built up front
+        _create_unique_index(c_tags, TAGS_KEY)
         for part in _chunked(tags_df, args.chunk_size):
             if part.empty:
                 continue
-            docs = part.to_dict(orient="records")
-            ops = [UpdateOne({"_tid": d["_tid"]}, {"$setOnInsert": d}, upsert=True) for d in docs]
-            try:
-                c_tags.bulk_write(ops, ordered=False)
-            except BulkWriteError:
-                pass
+            _insert_ignore_duplicates(c_tags, part.to_dict(orient="records"))
 
     # ---- Load links ----
     if not links_df.empty:
-        print("Upserting links...")
         link_docs = links_df.to_dict(orient="records")
-        _upsert_many(c_links, link_docs, key_field="movieId", chunk_size=args.chunk_size)
+        if args.rebuild:
+            print("Rebuilding links...")
+            _rebuild(c_links, link_docs)
+        else:
+            print("Upserting links...")
+            _upsert_many(c_links, link_docs, key_field="movieId", chunk_size=args.chunk_size)
 
     print("Creating indexes...")
     c_movies.create_index("movieId", unique=True)
     c_movies.create_index("genres")
+    if ratings_first_load:
+        _create_unique_index(c_ratings, RATINGS_KEY)
     c_ratings.create_index([("userId", 1), ("timestamp", -1)])
     c_ratings.create_index([("movieId", 1), ("timestamp", -1)])
-    c_ratings.create_index([("userId", 1), ("movieId", 1)])
     if not tags_df.empty:
         c_tags.create_index([("movieId", 1), ("timestamp", -1)])
         c_tags.create_index([("tag", 1)])
 
     print(f"Done. Database='{args.db}' populated.")
-    print("Collections now:", db.list_collection_names())
+    coll_names = db.list_collection_names()
+    print("Collections now:", coll_names)
+    # Metadata-based counts: O(1) instead of a full scan per collection
     print("Counts:",
-          "movies=", c_movies.count_documents({}),
-          "ratings=", c_ratings.count_documents({}),
-          "tags=", c_tags.count_documents({}) if "tags" in db.list_collection_names() else 0,
-          "links=", c_links.count_documents({}) if "links" in db.list_collection_names() else 0
+          "movies=", c_movies.estimated_document_count(),
+          "ratings=", c_ratings.estimated_document_count(),
+          "tags=", c_tags.estimated_document_count() if "tags" in coll_names else 0,
+          "links=", c_links.estimated_document_count() if "links" in coll_names else 0
           )
 
 
@@ -7,17 +7,50 @@ Creates/updates:
 - movie_features collection
 Exports:
 - features/ratings_features.csv
-- features/ratings_features.parquet (optional, if pyarrow installed)
+- features/ratings_features.parquet
 """
 
 from __future__ import annotations
 
 import argparse
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Tuple
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+# Server error codes for a $facet result that does not fit in one document:
+# BSONObjectTooLarge (16MB reply) and the $facet output size limit
+FACET_TOO_LARGE_ERRORS = {10334, 4031700}
+
+# Columns produced by pipeline_labeled_examples, in export order
+EXAMPLE_SCHEMA = pa.schema([
+    ("userId", pa.int64()),
+    ("movieId", pa.int64()),
+    ("rating", pa.float64()),
+    ("timestamp", pa.int64()),
+    ("user_rating_count", pa.int64()),
+    ("user_rating_avg", pa.float64()),
+    ("user_rating_std_approx", pa.float64()),
+    ("movie_rating_count", pa.int64()),
+    ("movie_rating_avg", pa.float64()),
+    ("movie_rating_std_approx", pa.float64()),
+    ("genres", pa.string()),
+])
+EXPORT_SCHEMA = EXAMPLE_SCHEMA.append(pa.field("genres_len", pa.int64()))
+
+# Ratings fields needed to compute user/movie features locally (--local-features)
+RATINGS_SCHEMA = pa.schema([
+    ("userId", pa.int64()),
+    ("movieId", pa.int64()),
+    ("rating", pa.float64()),
+    ("timestamp", pa.int64()),
+])
 
 
 def ensure_dir(path: str) -> None:
@@ -80,35 +113,63 @@ def pipeline_user_features() -> List[Dict[str, Any]]:
     ]
 
 
+def pipeline_all_features() -> List[Dict[str, Any]]:
+    """Movie and user features from a single ratings scan.
+
+    $facet returns one document, so both feature sets must fit in the 16MB BSON
+    limit together; compute_features falls back to two scans when they don't.
+    """
+    return [{"$facet": {"movies": pipeline_movie_features(), "users": pipeline_user_features()}}]
+
+
+def compute_features(db) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Movie and user features via $facet, or two separate aggregations if too large."""
+    try:
+        feats = next(db["ratings"].aggregate(pipeline_all_features(), allowDiskUse=True))
+        return feats["movies"], feats["users"]
+    except OperationFailure as e:
+        if e.code not in FACET_TOO_LARGE_ERRORS:
+            raise
+    print("$facet result too large; computing movie_features and user_features separately...")
+    movie_feats = list(db["ratings"].aggregate(pipeline_movie_features(), allowDiskUse=True))
+    user_feats = list(db["ratings"].aggregate(pipeline_user_features(), allowDiskUse=True))
+    return movie_feats, user_feats
+
+
+def lookup_by_key(from_collection: str, key: str, as_field: str, fields: List[str]) -> Dict[str, Any]:
+    """Equality $lookup on `key` that carries only `fields` into the joined document.
+
+    Uses the concise localField/foreignField + pipeline form (MongoDB 5.0+): the
+    join itself stays an indexed equality lookup on `from_collection.key` and the
+    $project runs on the matched document only.
+    """
+    return {
+        "$lookup": {
+            "from": from_collection,
+            "localField": key,
+            "foreignField": key,
+            "pipeline": [{"$project": {"_id": 0, **{f: 1 for f in fields}}}],
+            "as": as_field,
+        }
+    }
+
+
 def pipeline_labeled_examples(limit: int = 0) -> List[Dict[str, Any]]:
     p: List[Dict[str, Any]] = [
+        lookup_by_key("user_features", "userId", "u",
+                      ["user_rating_count", "user_rating_avg", "user_rating_std_approx"]),
+        lookup_by_key("movie_features", "movieId", "m",
+                      ["movie_rating_count", "movie_rating_avg", "movie_rating_std_approx"]),
+        lookup_by_key("movies", "movieId", "mv", ["genres"]),
+        # Inner-join semantics (as $unwind had), then take the single match directly
+        {"$match": {"u": {"$ne": []}, "m": {"$ne": []}, "mv": {"$ne": []}}},
         {
-            "$lookup": {
-                "from": "user_features",
-                "localField": "userId",
-                "foreignField": "userId",
-                "as": "u",
+            "$addFields": {
+                "u": {"$arrayElemAt": ["$u", 0]},
+                "m": {"$arrayElemAt": ["$m", 0]},
+                "mv": {"$arrayElemAt": ["$mv", 0]},
             }
         },
-        {"$unwind": "$u"},
-        {
-            "$lookup": {
-                "from": "movie_features",
-                "localField": "movieId",
-                "foreignField": "movieId",
-                "as": "m",
-            }
-        },
-        {"$unwind": "$m"},
-        {
-            "$lookup": {
-                "from": "movies",
-                "localField": "movieId",
-                "foreignField": "movieId",
-                "as": "mv",
-            }
-        },
-        {"$unwind": "$mv"},
         {
             "$project": {
                 "_id": 0,
@@ -132,13 +193,54 @@ def pipeline_labeled_examples(limit: int = 0) -> List[Dict[str, Any]]:
 
 
 def upsert_collection(db, target_collection: str, docs: List[Dict[str, Any]], key: str) -> None:
-    col = db[target_collection]
-    col.create_index(key, unique=True)
     if not docs:
+        db[target_collection].create_index(key, unique=True)
         return
-    # Replace all docs (simple for small datasets)
-    col.delete_many({})
-    col.insert_many(docs)
+    # Full refresh: load a staging collection, then swap it in with one rename so
+    # readers never see an empty or half-written target
+    tmp = db[f"{target_collection}_tmp"]
+    tmp.drop()
+    tmp.create_index(key, unique=True)
+    tmp.insert_many(docs, ordered=False)
+    tmp.rename(target_collection, dropTarget=True)
+
+
+def iter_record_batches(cursor, schema: pa.Schema, batch_size: int = 10_000) -> Iterator[pa.RecordBatch]:
+    """Stream cursor documents into Arrow record batches, column by column."""
+    names = schema.names
+    columns: Dict[str, List[Any]] = {name: [] for name in names}
+    n = 0
+    for doc in cursor:
+        for name in names:
+            columns[name].append(doc.get(name))
+        n += 1
+        if n == batch_size:
+            yield pa.RecordBatch.from_pydict(columns, schema=schema)
+            columns = {name: [] for name in names}
+            n = 0
+    if n:
+        yield pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def local_features(ratings: pd.DataFrame, key: str, prefix: str) -> List[Dict[str, Any]]:
+    """Same stats as pipeline_movie_features/pipeline_user_features, via pandas groupby."""
+    g = ratings.groupby(key, sort=False)
+    feats = pd.DataFrame({
+        f"{prefix}_rating_count": g["rating"].size(),
+        f"{prefix}_rating_avg": g["rating"].mean(),
+        f"{prefix}_rating_std_approx": g["rating"].std(ddof=0),  # $stdDevPop
+        f"{prefix}_rating_min": g["rating"].min(),
+        f"{prefix}_rating_max": g["rating"].max(),
+        f"{prefix}_last_ts": g["timestamp"].max(),
+    })
+    return feats.reset_index().to_dict(orient="records")
+
+
+def genres_len(genres: pa.Array) -> pa.Array:
+    """Number of "|"-separated genres per row (0 for empty/missing), vectorized."""
+    g = pc.fill_null(genres, "")
+    n = pc.add(pc.cast(pc.count_substring(g, "|"), pa.int64()), 1)
+    return pc.if_else(pc.equal(g, ""), 0, n)
 
 
 def main() -> None:
@@ -147,6 +249,8 @@ def main() -> None:
     ap.add_argument("--db", default="movielens")
     ap.add_argument("--out-dir", default="features")
     ap.add_argument("--limit", type=int, default=0, help="Optional limit for exported examples (0 = all)")
+    ap.add_argument("--local-features", action="store_true",
+                    help="Compute user/movie features with pandas instead of a MongoDB aggregation")
     args = ap.parse_args()
 
     ensure_dir(args.out_dir)
@@ -154,34 +258,43 @@ def main() -> None:
     client = MongoClient(args.mongo_uri)
     db = client[args.db]
 
-    print("Computing movie_features...")
-    movie_feats = list(db["ratings"].aggregate(pipeline_movie_features(), allowDiskUse=True))
+    if args.local_features:
+        print("Computing movie_features + user_features locally...")
+        projection = {"_id": 0, **{name: 1 for name in RATINGS_SCHEMA.names}}
+        batches = iter_record_batches(db["ratings"].find({}, projection), RATINGS_SCHEMA)
+        ratings = pa.Table.from_batches(batches, schema=RATINGS_SCHEMA).to_pandas()
+        movie_feats = local_features(ratings, "movieId", "movie")
+        user_feats = local_features(ratings, "userId", "user")
+    else:
+        print("Computing movie_features + user_features...")
+        movie_feats, user_feats = compute_features(db)
     upsert_collection(db, "movie_features", movie_feats, key="movieId")
-
-    print("Computing user_features...")
-    user_feats = list(db["ratings"].aggregate(pipeline_user_features(), allowDiskUse=True))
     upsert_collection(db, "user_features", user_feats, key="userId")
 
     print("Creating labeled examples dataset...")
-    examples = list(db["ratings"].aggregate(pipeline_labeled_examples(limit=args.limit), allowDiskUse=True))
-    df = pd.DataFrame(examples)
-
-    # Basic cleanup for ML:
-    # Convert genres string to simple counts as a baseline feature
-    # (More advanced: multi-hot encode genres; we do it in notebook)
-    df["genres_len"] = df["genres"].fillna("").apply(lambda s: len(str(s).split("|")) if s else 0)
+    # The movies $lookup probes this index; it normally comes from ingestion already
+    db["movies"].create_index("movieId", unique=True)
+    cursor = db["ratings"].aggregate(pipeline_labeled_examples(limit=args.limit), allowDiskUse=True)
 
     csv_path = os.path.join(args.out_dir, "ratings_features.csv")
-    df.to_csv(csv_path, index=False)
-    print(f"Wrote: {csv_path}  rows={len(df)} cols={len(df.columns)}")
+    pq_path = os.path.join(args.out_dir, "ratings_features.parquet")
+    rows = 0
+    with (
+        pcsv.CSVWriter(csv_path, EXPORT_SCHEMA) as csv_writer,
+        pq.ParquetWriter(pq_path, EXPORT_SCHEMA, compression="zstd") as pq_writer,
+    ):
+        for batch in iter_record_batches(cursor, EXAMPLE_SCHEMA):
+            # Basic cleanup for ML:
+            # Convert genres string to simple counts as a baseline feature
+            # (More advanced: multi-hot encode genres; we do it in notebook)
+            columns = batch.columns + [genres_len(batch.column("genres"))]
+            out = pa.RecordBatch.from_arrays(columns, schema=EXPORT_SCHEMA)
+            csv_writer.write_batch(out)
+            pq_writer.write_batch(out)
+            rows += out.num_rows
 
-    # Parquet optional (good for ML engineering)
-    try:
-        pq_path = os.path.join(args.out_dir, "ratings_features.parquet")
-        df.to_parquet(pq_path, index=False)
-        print(f"Wrote: {pq_path}")
-    except Exception as e:
-        print("Parquet export skipped (install pyarrow). Reason:", e)
+    print(f"Wrote: {csv_path}  rows={rows} cols={len(EXPORT_SCHEMA)}")
+    print(f"Wrote: {pq_path}")
 
 
 if __name__ == "__main__":